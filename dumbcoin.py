@@ -1,11 +1,140 @@
+import heapq
+import os
+import struct
 import time
+import weakref
 import json
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import count
+from operator import itemgetter
 from timeit import default_timer as timer
 from hashlib import sha256
 
+try:
+    from sha256_numba import find_proof as _find_proof_numba
+except ImportError:
+    _find_proof_numba = None
+
+try:
+    from sha256_cuda import find_proof as _find_proof_cuda
+except ImportError:
+    _find_proof_cuda = None
+
+# Keys are sorted so a transaction serializes, and hashes, the same way
+# however its dict was built
+try:
+    import orjson
+    _dumps_json = partial(orjson.dumps, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    def _dumps_json(obj):
+        # Matches orjson's compact UTF-8 output for the transactions used here
+        return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+# Number of proofs each worker process tries per task when mining in parallel
+_PROOF_BATCH_SIZE = 2 ** 14
+
+# Compiling the Numba search the first time takes several seconds, which only
+# pays off from complexity level 6, where a hashlib search takes as long
+_NUMBA_MAX_TARGET = 1 << (256 - 4 * 6)
+
+logger = logging.getLogger(__name__)
+
 class BlockchainException(Exception):
     pass
 
+def _merkle_levels(leaves):
+    """
+    Combines a list of leaf hashes pairwise, level by level, up to a single
+    root hash. A level with an odd number of hashes pairs the last one with
+    itself. An empty list has the hash of no data as its root.
+
+    Returns
+    -------
+    levels : list of lists of bytes
+        Every level of the tree, from the leaves up to the root
+    """
+    if not leaves:
+        return [[sha256().digest()]]
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = level + [level[-1]]
+        levels.append([sha256(level[i] + level[i + 1]).digest()
+                       for i in range(0, len(level), 2)])
+    return levels
+
+def _merkle_root(leaves):
+    return _merkle_levels(leaves)[-1][0]
+
+def _transaction_hash(transaction):
+    """Returns the Merkle leaf hash of a single serialized transaction."""
+    return sha256(_dumps_json(transaction)).digest()
+
+def _transactions_root(transactions):
+    """Returns the Merkle root of the hashes of each serialized transaction."""
+    return _merkle_root([_transaction_hash(transaction) for transaction in transactions])
+
+def verify_merkle_proof(transaction, merkle_proof, root):
+    """
+    Checks that a transaction is included under a Merkle root, using the
+    sibling hashes produced by `Block.get_merkle_proof`. Only the log2(n)
+    hashes on the transaction's path are needed, not the whole block.
+
+    Parameters
+    ----------
+    transaction : dict
+        The transaction to check
+    merkle_proof : list of tuples
+        (sibling_hash, sibling_is_left) pairs from the leaf up to the root
+    root : bytes
+        The `tx_merkle_root` of the block
+
+    Returns
+    -------
+    included : boolean
+    """
+    node = _transaction_hash(transaction)
+    for sibling, sibling_is_left in merkle_proof:
+        node = sha256(sibling + node if sibling_is_left else node + sibling).digest()
+    return node == root
+
+def _target_bytes(target):
+    """
+    Returns `target` as 32 big-endian bytes. Digests compare against these
+    bytes in the same order as their integer values, without converting each
+    digest to an int.
+    """
+    return min(target, (1 << 256) - 1).to_bytes(32, "big")
+
+def _search_proof(block_hash, target, start=0, stop=None):
+    """
+    Searches for the first proof in `range(start, stop)` which, when hashed
+    along with the `block_hash` digest bytes, produces a hash whose value is
+    below `target`. The search is unbounded if `stop` is None. Defined at
+    module level so that it can be sent to worker processes.
+
+    Returns
+    -------
+    proof : int or None
+        None if no proof in the range is valid
+    """
+    # The block hash prefix never changes between attempts, so hash it
+    # once and copy the SHA256 state for each candidate proof.
+    prefix_hash = sha256(block_hash)
+    target_bytes = _target_bytes(target)
+    proofs = count(start) if stop is None else range(start, stop)
+    for proof in proofs:
+        proof_hash = prefix_hash.copy()
+        proof_hash.update(b"%d" % proof)
+        if proof_hash.digest() < target_bytes:
+            return proof
+    return None
+
 class Block():
     """
     A cryptographically secured block of data that forms the basis of a
@@ -18,17 +147,21 @@ class Block():
     ----------
     index : int
         The index of the current block within the blockchain array
-    timestamp : float or datetime-like
-        Timestamp when the block was mined
+    timestamp : float
+        Timestamp when the block was mined, hashed as a little-endian double
     transactions : json-like or serializable
         A serializable block of data whose contents are cryptographically secured
     proof : int
         A number that, when hashed along with the current block's hash, will
-        produce a string whose first 4 bytes are 0s. A valid proof is required
-        for instantiation.
+        produce a hash below the blockchain's target (by default, one starting
+        with `complexity_level` 0s). A valid proof is required for
+        instantiation.
     previous_block : Block
         A reference to the previous block in the blockchain. The first block is
         initialized with None.
+    tx_merkle_root : bytes, optional
+        The Merkle root of the transactions, if the caller has already computed
+        it. Computed if not specified.
 
     Examples
     --------
@@ -48,39 +181,97 @@ class Block():
     BlockchainException
         when a block does not pass verification
     """
+    # Chains hold many blocks, so avoid a __dict__ per block
+    __slots__ = ("index", "timestamp", "_ts_bytes", "transactions", "tx_merkle_root",
+                 "proof", "previous_block", "hash_bytes", "_str_cache", "_verified")
 
-    def __init__(self, index, timestamp, transactions, proof, previous_block):
+    def __init__(self, index, timestamp, transactions, proof, previous_block,
+                 tx_merkle_root=None):
 
         self.index = index
         self.timestamp = timestamp
+        self._ts_bytes = struct.pack("<d", timestamp)
         self.transactions = transactions
+        if tx_merkle_root is None:
+            tx_merkle_root = _transactions_root(transactions)
+        self.tx_merkle_root = tx_merkle_root
         self.proof = proof
         self.previous_block = previous_block
-        self.hash = self.get_hash()
-
-    def get_hash(self):
+        self.hash_bytes = self.get_hash_bytes()
+        self._str_cache = None
+        # The (hash_bytes, proof, target) this block last passed verification
+        # with, if any
+        self._verified = None
+
+    @property
+    def hash(self):
+        """The block's hash as a hex string."""
+        return self.hash_bytes.hex()
+
+    def get_hash_bytes(self):
         """
-        Produces a hash string of the contents of the current block for
-        cryptographic security. Hash is based on a concatenated string of the
-        block's index, timestamp, and transaction data.
+        Produces a hash digest of the contents of the current block for
+        cryptographic security. Hash is based on the concatenated bytes of the
+        block's index, timestamp, number of transactions and the Merkle root of
+        its transactions, so its input stays small however many transactions
+        the block holds. The count is included because a Merkle root alone
+        doesn't tell [a, b, c] apart from [a, b, c, c].
 
         Returns
         -------
-        hash_value : string
+        hash_value : bytes
+            The 32 byte SHA256 digest
         """
-        block_string = "{}{}{}".format(self.index,
-                                       self.timestamp,
-                                       json.dumps(self.transactions))
+        block_bytes = b"%d%s%d%s" % (self.index,
+                                     self._ts_bytes,
+                                     len(self.transactions),
+                                     self.tx_merkle_root)
 
-        hash_value = sha256(block_string.encode()).hexdigest()
+        hash_value = sha256(block_bytes).digest()
         return hash_value
 
+    def get_merkle_proof(self, position):
+        """
+        Produces the sibling hashes linking one of the block's transactions
+        to its `tx_merkle_root`, which `verify_merkle_proof` checks.
+
+        Parameters
+        ----------
+        position : int
+            The index of the transaction within the block
+
+        Returns
+        -------
+        merkle_proof : list of tuples
+            (sibling_hash, sibling_is_left) pairs from the leaf up to the root
+
+        Raises
+        ------
+        IndexError
+            when `position` is not the index of one of the block's transactions
+        """
+        if not 0 <= position < len(self.transactions):
+            raise IndexError("Block has no transaction at position {}".format(position))
+        levels = _merkle_levels([_transaction_hash(transaction)
+                                 for transaction in self.transactions])
+        merkle_proof = []
+        for level in levels[:-1]:
+            sibling = position ^ 1
+            # The last hash of an odd level is paired with itself
+            sibling_hash = level[sibling] if sibling < len(level) else level[position]
+            merkle_proof.append((sibling_hash, sibling < position))
+            position //= 2
+        return merkle_proof
+
     def __str__(self):
-        string_template = "Block: {},\nTime: {},\nProof: {},\nTransactions: {}\n"
-        return string_template.format(self.index,
-                                      self.timestamp,
-                                      self.proof,
-                                      "\n".join([str(x) for x in self.transactions]))
+        # Blocks don't change once mined, so the string only needs building once
+        if self._str_cache is None:
+            string_template = "Block: {},\nTime: {},\nProof: {},\nTransactions: {}\n"
+            self._str_cache = string_template.format(self.index,
+                                                     self.timestamp,
+                                                     self.proof,
+                                                     "\n".join([str(x) for x in self.transactions]))
+        return self._str_cache
 
 class Blockchain():
     """
@@ -106,6 +297,23 @@ class Blockchain():
         a new block. Higher levels of complexity will require longer mining times
         but with the added benefit of additional security.
         Defaults to 4 if not specified.
+    target : int, optional
+        The value a block's verification hash, read as a 256 bit integer, must
+        be below. Defaults to the target matching `complexity_level`; passing a
+        target directly allows difficulty between whole "0"s.
+    workers : int, optional
+        The number of processes used to search for proofs when mining. Pass
+        None to use every available CPU. Defaults to 1, as starting worker
+        processes costs more than mining at low complexity levels. Ignored
+        from complexity level 6 when numba is installed, as the compiled
+        search uses every CPU. The worker processes are started once and
+        reused for every block. They are spawned, so the script creating the
+        Blockchain must guard its entry point with
+        `if __name__ == "__main__":`.
+    use_cuda : boolean, optional
+        Whether to search for proofs on a CUDA GPU, which requires numba and a
+        GPU; otherwise proofs are searched on the CPU. Defaults to False, as
+        the GPU search has so far only run under numba's CUDA simulator.
     last_block : Block
         A reference to the last block in the blockchain array
 
@@ -115,10 +323,30 @@ class Blockchain():
     >>> dumbcoin.verify_blockchain()
     True
     """
-    def __init__(self, seed_amount=1000, complexity_level=4):
+    def __init__(self, seed_amount=1000, complexity_level=4, workers=1, target=None,
+                 use_cuda=False):
         self.transactions = []
+        # (transaction, leaf hash) pairs for the transactions staged through
+        # add_transaction
+        self._transaction_hashes = []
         self.seed_amount = seed_amount
         self.complexity_level = complexity_level
+        # Each "0" of complexity is one hex digit, i.e. four bits of the hash
+        if target is None:
+            target = 1 << (256 - 4 * complexity_level)
+        elif target <= 0:
+            # No hash is below 0, so mining the genesis block would never end
+            raise ValueError("target must be positive, got {}".format(target))
+        self.target = target
+        self.workers = workers or os.cpu_count() or 1
+        self.use_cuda = use_cuda
+        # Worker processes for parallel proof searches, started on first use
+        self._executor = None
+        # Ledger of settled transactions, rebuilt lazily after each new block
+        self._ledger = None
+        # Settled transactions sorted by timestamp, up to block _settled_index
+        self._settled_transactions = []
+        self._settled_index = -1
         self.last_block = self.create_genesis_block()
 
     def add_transaction(self, sender, recipient, amount, timestamp=None, validate_transaction=True):
@@ -128,83 +356,142 @@ class Blockchain():
                        "recipient": recipient,
                        "amount": amount,
                        "timestamp": timestamp}
-        print("Staging transaction: {}".format(transaction))
+        logger.debug("Staging transaction: %s", transaction)
         if validate_transaction:
-            validated = self.validate_transaction(transaction,
-                                                        self.get_settled_transactions())
+            validated = self.validate_transaction(transaction)
             if not validated:
                 raise BlockchainException("Transaction failed to validate. Aborting")
-            print("Transaction validated against ledger")
+            logger.debug("Transaction validated against ledger")
+        # Hash before staging, so a transaction that can't be serialized
+        # leaves the staged transactions and their hashes in step
+        leaf = _transaction_hash(transaction)
         self.transactions.append(transaction)
-        print("Transaction stagged. {} transactions awaiting mining".format(len(self.transactions)))
+        self._transaction_hashes.append((transaction, leaf))
+        logger.debug("Transaction stagged. %d transactions awaiting mining", len(self.transactions))
+
+    def add_transactions(self, transactions, validate_transaction=True):
+        """
+        Stages several transactions, reading the clock once for the whole
+        batch rather than once per transaction.
+
+        Parameters
+        ----------
+        transactions : iterable of tuples
+            Each a (sender, recipient, amount) tuple, optionally followed by a
+            timestamp. Transactions without a timestamp share the same one.
+        validate_transaction : boolean, optional
+            Whether to validate each transaction against the ledger
+        """
+        now = time.time()
+        for sender, recipient, amount, *timestamp in transactions:
+            self.add_transaction(sender,
+                                 recipient,
+                                 amount,
+                                 timestamp[0] if timestamp else now,
+                                 validate_transaction)
 
     def add_block(self):
         if not self.transactions:
             raise BlockchainException("No transactions to add to block")
-        print("Mining new block with {} transactions".format(len(self.transactions)))
+        logger.info("Mining new block with %d transactions", len(self.transactions))
         new_block = self.mine_block()
         if not self.verify_block(new_block):
             raise BlockchainException("Block failed verification. Aborting")
         self.transactions = []
+        self._transaction_hashes = []
+        self._ledger = None
         self.last_block = new_block
-        print("Block successfully added to blockchain at index {}".format(new_block.index))
+        logger.info("Block successfully added to blockchain at index %d", new_block.index)
 
-    def verify_block(self, block):
+    def verify_block(self, block, force=False):
         """
-        Verifies if the current block is valid. Hashes the combined string of
-        the block's hash along with the proof. It then checks if the first four
-        bytes of the verification hash are 0s (which is the convention of this
+        Verifies if the current block is valid. Hashes the block's hash digest
+        followed by the digits of the proof. It then checks that the
+        verification hash, read as an integer, is below the blockchain's
+        target. With the default target this means its first
+        `complexity_level` hex digits are 0s (which is the convention of this
         blockchain).
 
+        A block that has passed against this target, or a harder one, is not
+        hashed again unless its hash or proof has changed since.
+
         Parameters
         ----------
         block : Block
             The block to have its contents verified
+        force : boolean, optional
+            Re-hash the block even if it has passed verification before
 
         Returns
         -------
         block_verified : boolean
         """
-        verification_hash = sha256("{}{}".format(block.hash,
-                                                 block.proof).encode()).hexdigest()
-        block_verified = verification_hash[:self.complexity_level] == ("0" * self.complexity_level)
+        verified = block._verified
+        if (not force and verified is not None
+                and verified[0] == block.hash_bytes and verified[1] == block.proof
+                and verified[2] <= self.target):
+            return True
+        verification_hash = sha256(block.hash_bytes + b"%d" % block.proof).digest()
+        block_verified = verification_hash < _target_bytes(self.target)
+        if block_verified:
+            block._verified = (block.hash_bytes, block.proof, self.target)
         return block_verified
 
-    def verify_blockchain(self):
-        def recursive_verify(block):
-            if self.verify_block(block):
-                if block.previous_block:
-                    return recursive_verify(block.previous_block)
-                else:
-                    return True
-            else:
+    def verify_blockchain(self, force=False):
+        block = self.last_block
+        while block:
+            if not self.verify_block(block, force):
                 return False
-        return recursive_verify(self.last_block)
+            block = block.previous_block
+        return True
 
     def get_settled_transactions(self):
+        # Only walk and sort blocks added since the last call, then merge them
+        # into the already sorted transactions
         transaction_list = []
-        def recursive_transactions(block):
-            for transaction in block.transactions:
-                transaction_list.append(transaction)
-            if block.previous_block:
-                recursive_transactions(block.previous_block)
-            else:
-                return
-        recursive_transactions(self.last_block)
-        transaction_list.sort(key=(lambda x: x['timestamp']), reverse=False)
-        return transaction_list
+        block = self.last_block
+        while block and block.index > self._settled_index:
+            transaction_list.extend(block.transactions)
+            block = block.previous_block
+        if transaction_list:
+            transaction_list.sort(key=itemgetter('timestamp'))
+            self._settled_transactions = list(heapq.merge(self._settled_transactions,
+                                                          transaction_list,
+                                                          key=itemgetter('timestamp')))
+            self._settled_index = self.last_block.index
+        return list(self._settled_transactions)
 
     def get_proof(self, block_hash):
-        proof = 0
-        proof_found = False
-        while not proof_found:
-            proof_hash = sha256("{}{}".format(block_hash,
-                                              proof).encode()).hexdigest()
-            if proof_hash[:self.complexity_level] == ("0" * self.complexity_level):
-                proof_found = True
-                break
-            proof += 1
-        return proof
+        if self.use_cuda and _find_proof_cuda is not None:
+            return _find_proof_cuda(block_hash, self.target)
+        if _find_proof_numba is not None and self.target <= _NUMBA_MAX_TARGET:
+            return _find_proof_numba(block_hash, self.target)
+        if self.workers == 1:
+            return _search_proof(block_hash, self.target)
+        if self._executor is None:
+            # Workers are spawned rather than forked, as forking after numba
+            # has started its threads can deadlock. Spawning re-imports this
+            # module in each worker, so they are kept for the next block.
+            self._executor = ProcessPoolExecutor(self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            weakref.finalize(self, self._executor.shutdown, cancel_futures=True)
+        # Hand out consecutive ranges of proofs and take the first hit in range
+        # order, so a parallel search finds the same proof as a serial one
+        pending = deque()
+        start = 0
+        while True:
+            while len(pending) < 2 * self.workers:
+                pending.append(self._executor.submit(_search_proof,
+                                                     block_hash,
+                                                     self.target,
+                                                     start,
+                                                     start + _PROOF_BATCH_SIZE))
+                start += _PROOF_BATCH_SIZE
+            proof = pending.popleft().result()
+            if proof is not None:
+                for future in pending:
+                    future.cancel()
+                return proof
 
     def create_genesis_block(self):
         process_start = timer()
@@ -214,36 +501,50 @@ class Blockchain():
                          "recipient": "genesis",
                          "amount": self.seed_amount,
                          "timestamp": timestamp}]
+        transactions_root = _transactions_root(transactions)
 
-        genesis_hash = sha256("{}{}{}".format(index,
-                                              timestamp,
-                                              json.dumps(transactions)).encode()).hexdigest()
+        genesis_hash = sha256(b"%d%s%d%s" % (index,
+                                             struct.pack("<d", timestamp),
+                                             len(transactions),
+                                             transactions_root)).digest()
         proof = self.get_proof(genesis_hash)
-        genesis_block = Block(index, timestamp, transactions, proof, None)
+        genesis_block = Block(index, timestamp, transactions, proof, None, transactions_root)
         process_end = timer()
-        print("Genesis block mined in {}s".format(process_end - process_start))
+        logger.info("Genesis block mined in %ss", process_end - process_start)
         return genesis_block
 
     def mine_block(self):
         process_start = timer()
         index = self.last_block.index + 1
         timestamp = time.time()
-        block_string = "{}{}{}".format(index,
-                                       timestamp,
-                                       json.dumps(self.transactions))
-        block_hash = sha256(block_string.encode()).hexdigest()
+        # Reuse the staged leaf hashes only if each still belongs to the
+        # transaction at its position, as `transactions` can be changed directly
+        staged = self._transaction_hashes
+        if (len(staged) == len(self.transactions)
+                and all(staged_transaction is transaction
+                        for (staged_transaction, _), transaction in zip(staged, self.transactions))):
+            transactions_root = _merkle_root([leaf for _, leaf in staged])
+        else:
+            transactions_root = _transactions_root(self.transactions)
+        block_bytes = b"%d%s%d%s" % (index,
+                                     struct.pack("<d", timestamp),
+                                     len(self.transactions),
+                                     transactions_root)
+        block_hash = sha256(block_bytes).digest()
         proof = self.get_proof(block_hash)
-        new_block = Block(index, timestamp, self.transactions, proof, self.last_block)
+        new_block = Block(index, timestamp, self.transactions, proof, self.last_block,
+                          transactions_root)
         process_end = timer()
-        print("New block at index {} mined in {}s".format(new_block.index,
-                                                          (process_end-process_start)))
+        logger.info("New block at index %d mined in %ss",
+                    new_block.index,
+                    process_end - process_start)
         return new_block
 
     def create_ledger(self, past_transactions):
         ledger = {}
         # Check the first block to make sure it's a genesis block
         genesis_block = past_transactions[0]
-        if genesis_block['recipient'] is not 'genesis' and genesis_block['sender'] is not None:
+        if genesis_block['recipient'] != 'genesis' or genesis_block['sender'] is not None:
             raise BlockchainException("Valid genesis block not found")
         # Set initial genesis value in ledger
         ledger[genesis_block['recipient']] = genesis_block['amount']
@@ -253,26 +554,46 @@ class Blockchain():
 
         return ledger
 
-    def add_transaction_to_ledger(self, transaction, ledger):
+    def get_ledger(self):
+        """
+        Returns the balances resulting from every settled transaction. The
+        ledger is cached until the next block is added, so validating staged
+        transactions doesn't rebuild it from the whole chain each time.
+
+        Returns
+        -------
+        ledger : dict
+            Balances keyed by account name. Must not be modified.
+        """
+        if self._ledger is None:
+            self._ledger = self.create_ledger(self.get_settled_transactions())
+        return self._ledger
+
+    def check_transaction(self, transaction, ledger):
         sender = transaction['sender']
-        recipient = transaction['recipient']
-        amount = transaction['amount']
-        if sender not in ledger.keys():
+        balance = ledger.get(sender)
+        if balance is None:
             raise BlockchainException("Sender {} made a transaction before appearing in the ledger".format(sender))
-        if (ledger[sender] - amount) < 0:
+        if (balance - transaction['amount']) < 0:
             raise BlockchainException("Sender {} attempted to overdraw their coins".format(sender))
-        if recipient not in ledger.keys():
-            ledger[recipient] = 0
-        ledger[sender] -= amount
-        ledger[recipient] += amount
+
+    def add_transaction_to_ledger(self, transaction, ledger):
+        recipient = transaction['recipient']
+        amount = transaction['amount']
+        self.check_transaction(transaction, ledger)
+        ledger[transaction['sender']] -= amount
+        ledger[recipient] = ledger.get(recipient, 0) + amount
 
         return ledger
 
-    def validate_transaction(self, new_transaction, past_transactions):
-        print("Validating transaction: {}".format(new_transaction))
-        ledger = self.create_ledger(past_transactions)
+    def validate_transaction(self, new_transaction, past_transactions=None):
+        logger.debug("Validating transaction: %s", new_transaction)
+        if past_transactions is None:
+            ledger = self.get_ledger()
+        else:
+            ledger = self.create_ledger(past_transactions)
         try:
-            self.add_transaction_to_ledger(new_transaction, ledger)
+            self.check_transaction(new_transaction, ledger)
         except BlockchainException:
             return False
 
@@ -280,13 +601,10 @@ class Blockchain():
 
     def __str__(self):
         block_strings = []
-        def recursive_strings(block):
+        block = self.last_block
+        while block:
             block_strings.append(block.__str__())
-            if block.previous_block:
-                recursive_strings(block.previous_block)
-            else:
-                return
-        recursive_strings(self.last_block)
+            block = block.previous_block
         blockchain_string = "\n".join(block_strings)
         return blockchain_string
 
@@ -0,0 +1,87 @@
+"""
+A proof of work search run on a CUDA GPU through numba.cuda. Each GPU thread
+hashes one proof, so a single launch tries hundreds of thousands of proofs.
+Launches are only worth their overhead at high difficulty, where a CPU search
+would take a long time, and dumbcoin only mines on the GPU when a Blockchain
+is created with `use_cuda=True`.
+
+Importing this module raises ImportError if numba is not installed or no CUDA
+GPU is available, in which case dumbcoin mines on the CPU.
+"""
+import numpy as np
+from numba import cuda, uint8, uint32
+
+import sha256_numba
+from sha256_numba import split_prefix, split_target
+
+if not cuda.is_available():
+    raise ImportError("No CUDA GPU is available")
+
+# Proofs tried per kernel launch are _BLOCKS * _THREADS_PER_BLOCK
+_BLOCKS = 1024
+_THREADS_PER_BLOCK = 256
+
+_NOT_FOUND = np.iinfo(np.int64).max
+
+# The device functions are compiled from the same Python source as the CPU
+# kernels in sha256_numba, so both search exactly the same way
+_compress = cuda.jit(device=True)(sha256_numba._compress.py_func)
+_write_message = cuda.jit(device=True)(sha256_numba._write_message.py_func)
+_message_end = cuda.jit(device=True)(sha256_numba._message_end.py_func)
+_below_target = cuda.jit(device=True)(sha256_numba._below_target.py_func)
+
+@cuda.jit
+def _search_kernel(midstate, tail, message_length, target, start, found):
+    """
+    Hashes proof `start` plus the thread's index, lowering `found[0]` to the
+    proof if its hash is below `target`.
+    """
+    proof = start + cuda.grid(1)
+    block = cuda.local.array(128, uint8)
+    digits = cuda.local.array(20, uint8)
+    w = cuda.local.array(64, uint32)
+    state = cuda.local.array(8, uint32)
+
+    tail_length = tail.shape[0]
+    for i in range(tail_length):
+        block[i] = tail[i]
+    digit_count = _write_message(block, tail_length, message_length, proof, digits)
+
+    for i in range(8):
+        state[i] = midstate[i]
+    for offset in range(0, _message_end(tail_length + digit_count), 64):
+        _compress(state, block, offset, w)
+
+    if _below_target(state, target):
+        cuda.atomic.min(found, 0, proof)
+
+def find_proof(prefix, target):
+    """
+    Finds the lowest proof which, when its decimal digits are appended to
+    `prefix` and hashed, produces a hash whose value is below `target`.
+
+    Parameters
+    ----------
+    prefix : bytes
+        The bytes hashed ahead of the proof
+    target : int
+        The 256 bit value the hash must be below
+
+    Returns
+    -------
+    proof : int
+    """
+    midstate, tail = split_prefix(prefix)
+    midstate = cuda.to_device(midstate)
+    tail = cuda.to_device(tail)
+    target_words = cuda.to_device(split_target(target))
+    found = cuda.to_device(np.array([_NOT_FOUND], dtype=np.int64))
+
+    start = 0
+    while True:
+        _search_kernel[_BLOCKS, _THREADS_PER_BLOCK](midstate, tail, len(prefix),
+                                                    target_words, start, found)
+        proof = found.copy_to_host()[0]
+        if proof != _NOT_FOUND:
+            return int(proof)
+        start += _BLOCKS * _THREADS_PER_BLOCK
@@ -0,0 +1,359 @@
+"""
+A proof of work search compiled with Numba. Mining in pure Python spends most
+of its time in the interpreter rather than in SHA256 itself, so this module
+implements the SHA256 compression function directly and scans proofs in
+machine code across every CPU.
+
+Importing this module raises ImportError if numba is not installed, in which
+case dumbcoin falls back to searching with hashlib.
+"""
+import numba
+import numpy as np
+from numba import njit, prange
+
+# Number of proofs each thread tries before the threads compare results
+_SHARD_SIZE = 4096
+
+_K = np.array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5,
+    0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc,
+    0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7,
+    0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3,
+    0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5,
+    0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+], dtype=np.uint32)
+
+_IV = np.array([
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+], dtype=np.uint32)
+
+# ASCII digits of 00 to 99, for writing numbers two digits at a time
+_DIGIT_PAIRS = np.frombuffer("".join("%02d" % i for i in range(100)).encode("ascii"),
+                             dtype=np.uint8).copy()
+
+@njit(cache=True, nogil=True)
+def _rotr(x, n):
+    return np.uint32((x >> np.uint32(n)) | (x << np.uint32(32 - n)))
+
+@njit(cache=True, nogil=True)
+def _compress(state, data, offset, w):
+    """
+    Runs the SHA256 compression function over the 64 bytes of `data` starting
+    at `offset`, updating `state` in place. `w` is scratch space for the
+    message schedule. Words are truncated back to uint32 after each addition.
+    """
+    for i in range(16):
+        j = offset + 4 * i
+        w[i] = ((np.uint32(data[j]) << np.uint32(24)) | (np.uint32(data[j + 1]) << np.uint32(16))
+                | (np.uint32(data[j + 2]) << np.uint32(8)) | np.uint32(data[j + 3]))
+    for i in range(16, 64):
+        x = w[i - 15]
+        y = w[i - 2]
+        s0 = _rotr(x, 7) ^ _rotr(x, 18) ^ (x >> np.uint32(3))
+        s1 = _rotr(y, 17) ^ _rotr(y, 19) ^ (y >> np.uint32(10))
+        w[i] = np.uint32(w[i - 16] + s0 + w[i - 7] + s1)
+
+    a, b, c, d = state[0], state[1], state[2], state[3]
+    e, f, g, h = state[4], state[5], state[6], state[7]
+    for i in range(64):
+        s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+        ch = (e & f) ^ (~e & g)
+        t1 = np.uint32(h + s1 + ch + _K[i] + w[i])
+        s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        t2 = np.uint32(s0 + maj)
+        h = g
+        g = f
+        f = e
+        e = np.uint32(d + t1)
+        d = c
+        c = b
+        b = a
+        a = np.uint32(t1 + t2)
+
+    state[0] += a
+    state[1] += b
+    state[2] += c
+    state[3] += d
+    state[4] += e
+    state[5] += f
+    state[6] += g
+    state[7] += h
+
+@njit(cache=True, nogil=True)
+def _midstate(data, length):
+    """Returns the SHA256 state after compressing the first `length` bytes of `data`."""
+    state = _IV.copy()
+    w = np.empty(64, dtype=np.uint32)
+    for offset in range(0, length, 64):
+        _compress(state, data, offset, w)
+    return state
+
+@njit(cache=True, nogil=True)
+def _compress_2way(state_a, state_b, data_a, data_b, offset, w_a, w_b):
+    """
+    Runs `_compress` over two independent messages at once. A SHA256 round
+    depends on the previous one, so interleaving the rounds of two hashes
+    lets the CPU overlap them instead of waiting on a single chain.
+    """
+    for i in range(16):
+        j = offset + 4 * i
+        w_a[i] = ((np.uint32(data_a[j]) << np.uint32(24)) | (np.uint32(data_a[j + 1]) << np.uint32(16))
+                  | (np.uint32(data_a[j + 2]) << np.uint32(8)) | np.uint32(data_a[j + 3]))
+        w_b[i] = ((np.uint32(data_b[j]) << np.uint32(24)) | (np.uint32(data_b[j + 1]) << np.uint32(16))
+                  | (np.uint32(data_b[j + 2]) << np.uint32(8)) | np.uint32(data_b[j + 3]))
+    for i in range(16, 64):
+        x = w_a[i - 15]
+        y = w_a[i - 2]
+        s0 = _rotr(x, 7) ^ _rotr(x, 18) ^ (x >> np.uint32(3))
+        s1 = _rotr(y, 17) ^ _rotr(y, 19) ^ (y >> np.uint32(10))
+        w_a[i] = np.uint32(w_a[i - 16] + s0 + w_a[i - 7] + s1)
+        x = w_b[i - 15]
+        y = w_b[i - 2]
+        s0 = _rotr(x, 7) ^ _rotr(x, 18) ^ (x >> np.uint32(3))
+        s1 = _rotr(y, 17) ^ _rotr(y, 19) ^ (y >> np.uint32(10))
+        w_b[i] = np.uint32(w_b[i - 16] + s0 + w_b[i - 7] + s1)
+
+    a, b, c, d = state_a[0], state_a[1], state_a[2], state_a[3]
+    e, f, g, h = state_a[4], state_a[5], state_a[6], state_a[7]
+    a2, b2, c2, d2 = state_b[0], state_b[1], state_b[2], state_b[3]
+    e2, f2, g2, h2 = state_b[4], state_b[5], state_b[6], state_b[7]
+    for i in range(64):
+        s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+        s1_2 = _rotr(e2, 6) ^ _rotr(e2, 11) ^ _rotr(e2, 25)
+        ch = (e & f) ^ (~e & g)
+        ch2 = (e2 & f2) ^ (~e2 & g2)
+        t1 = np.uint32(h + s1 + ch + _K[i] + w_a[i])
+        t1_2 = np.uint32(h2 + s1_2 + ch2 + _K[i] + w_b[i])
+        s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+        s0_2 = _rotr(a2, 2) ^ _rotr(a2, 13) ^ _rotr(a2, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        maj2 = (a2 & b2) ^ (a2 & c2) ^ (b2 & c2)
+        t2 = np.uint32(s0 + maj)
+        t2_2 = np.uint32(s0_2 + maj2)
+        h = g
+        h2 = g2
+        g = f
+        g2 = f2
+        f = e
+        f2 = e2
+        e = np.uint32(d + t1)
+        e2 = np.uint32(d2 + t1_2)
+        d = c
+        d2 = c2
+        c = b
+        c2 = b2
+        b = a
+        b2 = a2
+        a = np.uint32(t1 + t2)
+        a2 = np.uint32(t1_2 + t2_2)
+
+    state_a[0] += a
+    state_a[1] += b
+    state_a[2] += c
+    state_a[3] += d
+    state_a[4] += e
+    state_a[5] += f
+    state_a[6] += g
+    state_a[7] += h
+    state_b[0] += a2
+    state_b[1] += b2
+    state_b[2] += c2
+    state_b[3] += d2
+    state_b[4] += e2
+    state_b[5] += f2
+    state_b[6] += g2
+    state_b[7] += h2
+
+@njit(cache=True, nogil=True)
+def _write_digits(digits, n):
+    """
+    Writes the decimal digits of `n` at the end of the `digits` buffer, two at
+    a time from `_DIGIT_PAIRS`, and returns the position of the first one.
+    """
+    position = len(digits)
+    while n >= 100:
+        pair = (n % 100) * 2
+        n //= 100
+        position -= 2
+        digits[position] = _DIGIT_PAIRS[pair]
+        digits[position + 1] = _DIGIT_PAIRS[pair + 1]
+    if n >= 10:
+        position -= 2
+        digits[position] = _DIGIT_PAIRS[n * 2]
+        digits[position + 1] = _DIGIT_PAIRS[n * 2 + 1]
+    else:
+        position -= 1
+        digits[position] = 48 + n
+    return position
+
+@njit(cache=True, nogil=True)
+def _write_message(block, tail_length, message_length, proof, digits):
+    """
+    Writes the decimal digits of `proof` into `block` after the prefix tail,
+    followed by the SHA256 padding. Returns the number of digits written.
+    """
+    position = _write_digits(digits, proof)
+    digit_count = len(digits) - position
+    for i in range(digit_count):
+        block[tail_length + i] = digits[position + i]
+    length = tail_length + digit_count
+    block[length] = 0x80
+    end = _message_end(length)
+    for i in range(length + 1, end - 8):
+        block[i] = 0
+    bits = (message_length + digit_count) * 8
+    for i in range(8):
+        block[end - 1 - i] = (bits >> (8 * i)) & 0xFF
+    return digit_count
+
+@njit(cache=True, nogil=True)
+def _message_end(length):
+    """Returns the padded size of a final message of `length` bytes, 64 or 128."""
+    return 64 if length + 9 <= 64 else 128
+
+@njit(cache=True, nogil=True)
+def _advance_digits(block, tail_length, digit_count, step):
+    """
+    Adds `step` (below 10) to the decimal digits already in `block`, carrying
+    like an odometer. Returns False if the carry runs off the first digit, in
+    which case the message needs rewriting with `_write_message`.
+    """
+    i = tail_length + digit_count - 1
+    digit = block[i] - 48 + step
+    while digit >= 10:
+        block[i] = 48 + digit - 10
+        i -= 1
+        if i < tail_length:
+            return False
+        digit = block[i] - 48 + 1
+    block[i] = 48 + digit
+    return True
+
+@njit(cache=True, nogil=True)
+def _below_target(state, target):
+    """Compares the hash in `state` with `target`, both as big-endian words."""
+    for i in range(8):
+        if state[i] != target[i]:
+            return state[i] < target[i]
+    return False
+
+@njit(cache=True, nogil=True)
+def _search_shard(midstate, tail, message_length, target, start, stop):
+    """
+    Returns the first proof in `range(start, stop)` whose hash is below
+    `target`, or -1. `tail` holds the prefix bytes not already compressed into
+    `midstate`, and `message_length` is the total length of the prefix.
+    Proofs are hashed two at a time with `_compress_2way`, and their digits
+    are stepped in place rather than rewritten for every proof.
+    """
+    state_a = np.empty(8, dtype=np.uint32)
+    state_b = np.empty(8, dtype=np.uint32)
+    w_a = np.empty(64, dtype=np.uint32)
+    w_b = np.empty(64, dtype=np.uint32)
+    block_a = np.zeros(128, dtype=np.uint8)
+    block_b = np.zeros(128, dtype=np.uint8)
+    digits = np.empty(20, dtype=np.uint8)
+    tail_length = len(tail)
+    block_a[:tail_length] = tail
+    block_b[:tail_length] = tail
+
+    proof = start
+    digits_a = _write_message(block_a, tail_length, message_length, proof, digits)
+    digits_b = _write_message(block_b, tail_length, message_length, proof + 1, digits)
+    while proof < stop:
+        end_a = _message_end(tail_length + digits_a)
+        end_b = _message_end(tail_length + digits_b)
+        state_a[:] = midstate
+
+        # Pairs straddling a change in block count are rare, hash them singly
+        if proof + 1 < stop and end_a == end_b:
+            state_b[:] = midstate
+            for offset in range(0, end_a, 64):
+                _compress_2way(state_a, state_b, block_a, block_b, offset, w_a, w_b)
+            if _below_target(state_a, target):
+                return proof
+            if _below_target(state_b, target):
+                return proof + 1
+            step = 2
+        else:
+            for offset in range(0, end_a, 64):
+                _compress(state_a, block_a, offset, w_a)
+            if _below_target(state_a, target):
+                return proof
+            step = 1
+
+        proof += step
+        if not _advance_digits(block_a, tail_length, digits_a, step):
+            digits_a = _write_message(block_a, tail_length, message_length, proof, digits)
+        if not _advance_digits(block_b, tail_length, digits_b, step):
+            digits_b = _write_message(block_b, tail_length, message_length, proof + 1, digits)
+    return -1
+
+@njit(cache=True, nogil=True, parallel=True)
+def _search_round(midstate, tail, message_length, target, start, shards):
+    """
+    Searches `shards` consecutive shards of proofs in parallel, returning the
+    lowest valid proof found or -1.
+    """
+    found = np.empty(shards, dtype=np.int64)
+    for shard in prange(shards):
+        shard_start = start + shard * _SHARD_SIZE
+        found[shard] = _search_shard(midstate, tail, message_length, target,
+                                     shard_start, shard_start + _SHARD_SIZE)
+    for shard in range(shards):
+        if found[shard] >= 0:
+            return found[shard]
+    return -1
+
+def split_prefix(prefix):
+    """
+    Compresses the whole 64 byte blocks of `prefix`, returning the resulting
+    SHA256 state and the leftover bytes to hash with each proof.
+    """
+    data = np.frombuffer(prefix, dtype=np.uint8)
+    compressed_length = len(prefix) - len(prefix) % 64
+    return _midstate(data, compressed_length), data[compressed_length:].copy()
+
+def split_target(target):
+    """Returns a 256 bit target as eight big-endian uint32 words."""
+    target = min(target, (1 << 256) - 1)
+    return np.array([(target >> (32 * (7 - i))) & 0xFFFFFFFF for i in range(8)],
+                    dtype=np.uint32)
+
+def find_proof(prefix, target):
+    """
+    Finds the lowest proof which, when its decimal digits are appended to
+    `prefix` and hashed, produces a hash whose value is below `target`.
+
+    Parameters
+    ----------
+    prefix : bytes
+        The bytes hashed ahead of the proof
+    target : int
+        The 256 bit value the hash must be below
+
+    Returns
+    -------
+    proof : int
+    """
+    midstate, tail = split_prefix(prefix)
+    target_words = split_target(target)
+    shards = numba.get_num_threads()
+    start = 0
+    while True:
+        proof = _search_round(midstate, tail, len(prefix), target_words, start, shards)
+        if proof >= 0:
+            return int(proof)
+        start += shards * _SHARD_SIZE
@@ -1,5 +1,13 @@
+import os
+import subprocess
+import sys
+import time
+from decimal import Decimal
 import unittest
-from dumbcoin import Blockchain, BlockchainException
+from hashlib import sha256
+from unittest import mock
+import dumbcoin
+from dumbcoin import Block, Blockchain, BlockchainException, verify_merkle_proof
 
 class BlockchainTest(unittest.TestCase):
     def setUp(self):
@@ -8,6 +16,15 @@ class BlockchainTest(unittest.TestCase):
         self.assertTrue(self.blockchain.verify_blockchain())
         self.assertTrue(self.blockchain.verify_block(self.blockchain.last_block))
 
+    def test_tampered_blockchain(self):
+        self.blockchain.add_transaction("genesis", "adam", 1000)
+        self.blockchain.add_block()
+        self.assertTrue(self.blockchain.verify_blockchain())
+        self.blockchain.last_block.previous_block.proof += 1
+        self.assertFalse(self.blockchain.verify_block(self.blockchain.last_block.previous_block))
+        self.assertFalse(self.blockchain.verify_blockchain())
+        self.assertFalse(self.blockchain.verify_blockchain(force=True))
+
     def test_transaction_validation(self):
         with self.assertRaises(BlockchainException):
             self.blockchain.add_transaction("foo", "bar", 10)
@@ -22,5 +39,153 @@ class BlockchainTest(unittest.TestCase):
         self.blockchain.add_block()
         self.assertTrue(self.blockchain.verify_blockchain())
 
+    def test_ledger_after_block(self):
+        self.blockchain.add_transaction("genesis", "adam", 1000)
+        self.assertEqual(self.blockchain.get_ledger(), {"genesis": 2000})
+        self.blockchain.add_block()
+        self.assertEqual(self.blockchain.get_ledger(), {"genesis": 1000, "adam": 1000})
+        self.blockchain.add_transaction("adam", "eve", 1000)
+        with self.assertRaises(BlockchainException):
+            self.blockchain.add_transaction("eve", "cain", 1)
+        self.assertEqual(self.blockchain.get_ledger(), {"genesis": 1000, "adam": 1000})
+
+    def test_invalid_genesis(self):
+        now = time.time()
+        for sender, recipient in [(None, "adam"), ("adam", "genesis")]:
+            with self.assertRaises(BlockchainException):
+                self.blockchain.create_ledger([{"sender": sender,
+                                                "recipient": recipient,
+                                                "amount": 1000,
+                                                "timestamp": now}])
+
+    def test_batch_transactions(self):
+        later = time.time() + 60
+        self.blockchain.add_transactions([("genesis", "adam", 1000),
+                                          ("genesis", "eve", 1000),
+                                          ("genesis", "eve", 0, later)])
+        timestamps = [transaction["timestamp"] for transaction in self.blockchain.transactions]
+        self.assertEqual(timestamps[0], timestamps[1])
+        self.assertEqual(timestamps[2], later)
+        with self.assertRaises(BlockchainException):
+            self.blockchain.add_transactions([("foo", "bar", 10)])
+        self.blockchain.add_block()
+        self.assertTrue(self.blockchain.verify_blockchain())
+
+    def test_merkle_proof(self):
+        for name in ["adam", "eve", "cain", "abel", "seth"]:
+            self.blockchain.add_transaction("genesis", name, 100)
+        self.blockchain.add_block()
+        block = self.blockchain.last_block
+        for position, transaction in enumerate(block.transactions):
+            merkle_proof = block.get_merkle_proof(position)
+            self.assertTrue(verify_merkle_proof(transaction, merkle_proof, block.tx_merkle_root))
+            forged = dict(transaction, amount=1000)
+            self.assertFalse(verify_merkle_proof(forged, merkle_proof, block.tx_merkle_root))
+        for position in [-1, len(block.transactions)]:
+            with self.assertRaises(IndexError):
+                block.get_merkle_proof(position)
+        with self.assertRaises(IndexError):
+            self.blockchain.last_block.previous_block.get_merkle_proof(1)
+
+    def test_duplicated_last_transaction(self):
+        # An odd Merkle level pairs its last hash with itself, so [a, b, c]
+        # and [a, b, c, c] share a root but must not share a block hash
+        transactions = [{"sender": "genesis", "recipient": name, "amount": 1, "timestamp": 1.0}
+                        for name in ["adam", "eve", "cain"]]
+        block = Block(1, 1.0, transactions, 0, None)
+        duplicated = Block(1, 1.0, transactions + [transactions[-1]], 0, None)
+        self.assertEqual(block.tx_merkle_root, duplicated.tx_merkle_root)
+        self.assertNotEqual(block.hash, duplicated.hash)
+
+    def test_unserializable_transaction(self):
+        with self.assertRaises(TypeError):
+            self.blockchain.add_transaction("genesis", "adam", Decimal(1))
+        self.assertEqual(self.blockchain.transactions, [])
+        self.blockchain.add_transaction("genesis", "eve", 100)
+        self.blockchain.transactions.append({"sender": "genesis",
+                                             "recipient": "cain",
+                                             "amount": 100,
+                                             "timestamp": time.time()})
+        self.blockchain.add_block()
+        block = self.blockchain.last_block
+        for position, transaction in enumerate(block.transactions):
+            merkle_proof = block.get_merkle_proof(position)
+            self.assertTrue(verify_merkle_proof(transaction, merkle_proof, block.tx_merkle_root))
+
+    def test_replaced_transaction(self):
+        self.blockchain.add_transaction("genesis", "adam", 100)
+        self.blockchain.transactions[0] = {"sender": "genesis",
+                                           "recipient": "eve",
+                                           "amount": 100,
+                                           "timestamp": time.time()}
+        self.blockchain.add_block()
+        block = self.blockchain.last_block
+        merkle_proof = block.get_merkle_proof(0)
+        self.assertTrue(verify_merkle_proof(block.transactions[0], merkle_proof, block.tx_merkle_root))
+
+    def test_long_blockchain(self):
+        # Walking the chain must not be limited by the recursion limit
+        blockchain = Blockchain(2000, complexity_level=1)
+        for i in range(sys.getrecursionlimit() + 10):
+            blockchain.add_transaction("genesis", "adam", 1, validate_transaction=False)
+            blockchain.add_block()
+        self.assertTrue(blockchain.verify_blockchain())
+        self.assertEqual(len(blockchain.get_settled_transactions()), len(blockchain))
+        self.assertEqual(len(str(blockchain).split("Block: ")) - 1, len(blockchain))
+
+    def test_custom_target(self):
+        # Halfway between complexity levels 2 and 3
+        blockchain = Blockchain(2000, target=1 << 245)
+        verification_hash = sha256(blockchain.last_block.hash_bytes
+                                   + str(blockchain.last_block.proof).encode())
+        self.assertLess(int(verification_hash.hexdigest(), 16), 1 << 245)
+        self.assertTrue(blockchain.verify_blockchain())
+        for target in [0, -1]:
+            with self.assertRaises(ValueError):
+                Blockchain(2000, target=target)
+
+    def test_parallel_proof(self):
+        # Compare the hashlib search with the process pool, not with numba
+        with mock.patch.object(dumbcoin, "_find_proof_numba", None):
+            serial = Blockchain(2000, complexity_level=3)
+            parallel = Blockchain(2000, complexity_level=3, workers=2)
+            block_hash = serial.last_block.hash_bytes
+            self.assertEqual(serial.get_proof(block_hash), parallel.get_proof(block_hash))
+            self.assertTrue(parallel.verify_blockchain())
+
+    def test_numba_proof(self):
+        try:
+            from sha256_numba import find_proof
+        except ImportError:
+            self.skipTest("numba is not installed")
+        # Cover prefixes whose proof lands in one or two SHA256 blocks
+        for length in range(0, 130, 7):
+            prefix = bytes(range(length))
+            proof = find_proof(prefix, 1 << 248)
+            hashes = [sha256(prefix + str(p).encode()).hexdigest() for p in range(proof + 1)]
+            self.assertTrue(hashes[-1].startswith("00"))
+            self.assertFalse(any(h.startswith("00") for h in hashes[:-1]))
+
+    def test_cuda_proof(self):
+        try:
+            import numba
+        except ImportError:
+            self.skipTest("numba is not installed")
+        # Run the GPU search under numba's simulator, which has to be enabled
+        # before numba.cuda is imported, with a small grid to keep it quick
+        script = """
+import sha256_cuda, sha256_numba
+sha256_cuda._BLOCKS = 4
+sha256_cuda._THREADS_PER_BLOCK = 64
+for length in (0, 25, 55, 56, 64, 100):
+    prefix = bytes(range(length))
+    assert sha256_cuda.find_proof(prefix, 1 << 248) == sha256_numba.find_proof(prefix, 1 << 248), length
+"""
+        result = subprocess.run([sys.executable, "-W", "ignore", "-c", script],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=dict(os.environ, NUMBA_ENABLE_CUDASIM="1"),
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
 if __name__ == '__main__':
     unittest.main()